@@ -8,6 +8,7 @@ Endpoints:
     - GET /shopify/order-by-confirmation-number-and-email
     - GET /shopify/products
     - GET /shopify/get-product-url
+    - GET /metrics
 
 To run the application locally:
     1. Install dependencies
@@ -15,16 +16,133 @@ To run the application locally:
     2. Run the application
         $ python app.py
     3. Use curl or Postman to test the endpoints.
+
+In production the app is served by gunicorn gevent workers (see apprunner.yaml),
+so route handlers stay synchronous and Shopify I/O yields cooperatively:
+    $ gunicorn --config gunicorn.conf.py --worker-class gevent --workers 4 --worker-connections 200 app:app
 """
+import atexit
+import functools
 import logging
-from flask import Flask, request, jsonify
-
-from shopify import GetOrders, GetProducts, GetCustomerID, GetOrdersForCustomerId
-
+import logging.handlers
+import os
+import queue
+import re
+import orjson
+from flask import Flask, Response, request
+from flask_compress import Compress
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+
+from shopify import GetOrders, GetProducts, ShopifyTimeoutError, ShopifyTransientError
+
+# Log records are handed to a background listener so stream I/O stays off the
+# request path. LOG_LEVEL lets production run quieter than INFO.
+_LOG_QUEUE = queue.SimpleQueue()
+_QUEUE_HANDLER = logging.handlers.QueueHandler(_LOG_QUEUE)
+_QUEUE_HANDLER.setFormatter(logging.Formatter('%(message)s')) # Listener adds the prefix.
 logging.basicConfig(
-    level=logging.INFO
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    handlers=[_QUEUE_HANDLER],
 )
+_LOG_HANDLER = logging.StreamHandler()
+_LOG_HANDLER.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, _LOG_HANDLER)
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)
+
 app = Flask(__name__)
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 1024 # Not worth compressing small error bodies.
+Compress(app)
+
+# Product URLs are a pure function of the query args. Product search results
+# depend on the caller's access token, so only the client may cache them.
+PRODUCT_URL_CACHE_CONTROL = 'public, max-age=86400, immutable'
+PRODUCTS_CACHE_CONTROL = 'private, max-age=60, stale-while-revalidate=300'
+
+# Cheap input checks so malformed requests fail before a Shopify round-trip.
+_STORE_RE = re.compile(r'^[a-z0-9][a-z0-9-]{1,59}$', re.IGNORECASE)
+_ORDER_RE = re.compile(r'^#?\d{1,20}$')
+_EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+_PRODUCT_ID_RE = re.compile(r'^\d{1,20}$')
+_CONFIRMATION_NUMBER_RE = re.compile(r'^[A-Za-z0-9]{1,32}$')
+_PRODUCT_HANDLE_RE = re.compile(r'^[\w-]{1,255}$')
+_API_VERSION_RE = re.compile(r'^(\d{4}-\d{2}|unstable)$')
+MAX_PRODUCT_NAME_LENGTH = 128
+
+# Query arg name -> (validity check, error message), applied by shopify_route.
+_ARG_CHECKS = {
+    'store_name': (_STORE_RE.match, "Malformed store_name."),
+    'order_number': (_ORDER_RE.match, "Malformed order_number."),
+    'email': (_EMAIL_RE.match, "Malformed email."),
+    'confirmation_number': (_CONFIRMATION_NUMBER_RE.match, "Malformed confirmation_number."),
+    'product_id': (_PRODUCT_ID_RE.match, "Malformed product_id."),
+    'product_name': (lambda value: len(value) <= MAX_PRODUCT_NAME_LENGTH,
+                     f"product_name is longer than {MAX_PRODUCT_NAME_LENGTH} characters."),
+    'product_handle': (_PRODUCT_HANDLE_RE.match, "Malformed product_handle."),
+    'api_version': (_API_VERSION_RE.match, "Malformed api_version."),
+}
+
+# gunicorn runs several worker processes; with PROMETHEUS_MULTIPROC_DIR set (as
+# gunicorn.conf.py does), each writes its metrics there and /metrics aggregates
+# them. Without it, /metrics only reports the worker that served the scrape.
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    _METRICS_REGISTRY = CollectorRegistry()
+    multiprocess.MultiProcessCollector(_METRICS_REGISTRY)
+else:
+    _METRICS_REGISTRY = REGISTRY
+
+# Encoded once; the missing-token response is the most common rejection.
+_NO_TOKEN_BODY = orjson.dumps({"error": "Missing or invalid Shopify token in request headers"})
+
+
+def shopify_route(required: tuple = (), optional: tuple = (), error_message: str = "An error occurred."):
+    """Decorator for routes that call Shopify on behalf of the caller.
+
+    Reads the X-Shopify-Access-Token header and the named query args, rejects bad
+    input with a 400, and calls the route as `fn(shopify_access_token, args)`.
+    ValueErrors from the route become 400s, Shopify timeouts become 504s, other
+    retryable Shopify failures become 502s, and any other error becomes a 500 with
+    `error_message`. `api_version` is always passed through as an optional arg.
+    """
+    names = (*required, *optional, 'api_version')
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper():
+            shopify_access_token = request.headers.get('X-Shopify-Access-Token')
+            if not shopify_access_token:
+                return Response(_NO_TOKEN_BODY, status=400, mimetype='application/json')
+
+            args = {name: request.args.get(name) for name in names}
+            missing = [name for name in required if not args[name]]
+            if missing:
+                return ojsonify({"error": f"Missing required parameter(s): {', '.join(missing)}."}), 400
+            invalid = _invalid_arg(args)
+            if invalid:
+                return ojsonify({"error": f"Invalid parameter provided. {invalid}"}), 400
+
+            try:
+                return fn(shopify_access_token, args)
+
+            except ValueError as e:
+                app.logger.error("ValueError: %s", e)
+                return ojsonify({"error": f"Invalid parameter provided. {e}"}), 400
+
+            except ShopifyTimeoutError as e:
+                app.logger.error("Timeout in %s: %s", fn.__name__, e)
+                return ojsonify({"error": "Timed out waiting for Shopify."}), 504
+
+            except ShopifyTransientError as e:
+                app.logger.error("Transient Shopify error in %s: %s", fn.__name__, e)
+                return ojsonify({"error": "Shopify is temporarily unavailable. Please retry."}), 502
+
+            except Exception as e:
+                app.logger.error("Error in %s: %s", fn.__name__, e)
+                return ojsonify({"error": error_message}), 500
+
+        return wrapper
+    return decorator
 
 
 @app.route('/')
@@ -33,8 +151,16 @@ def health_check():
     return "Ok.", 200
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics, including per-operation Shopify call latency and response size."""
+    return Response(generate_latest(_METRICS_REGISTRY), content_type=CONTENT_TYPE_LATEST)
+
+
 @app.route('/shopify/order-by-number', methods=['GET'])
-def shopify_order_by_number():
+@shopify_route(required=('store_name', 'order_number'),
+               error_message="An error occurred while retrieving orders.")
+def shopify_order_by_number(shopify_access_token: str, args: dict):
     """Get a shopify order by order number.
 
     Headers:
@@ -48,34 +174,22 @@ def shopify_order_by_number():
     Returns:
         A json object with field `order` that contains the order info.
     """
-    shopify_access_token = request.headers.get('X-Shopify-Access-Token')
-    if not shopify_access_token:
-        return jsonify({"error": "Missing or invalid Shopify token in request headers"}), 400
-    store_name = request.args.get('store_name')
-    shopify_api_version = request.args.get('api_version')
-    order_number = request.args.get('order_number')
-    try:
-        orders = GetOrders(store_name, shopify_access_token, shopify_api_version, 
-                           order_number=order_number)
-        app.logger.info(f"Num orders found for {order_number}: {len(orders)}")
-
-        order = orders[0] if orders else f'No orders with order number {order_number} found.'
-        return jsonify({
-            'order': order,
-        }), 200
-    
-    except ValueError as e:
-        app.logger.error(f"ValueError: {e}")
-        return jsonify({"error": f"Invalid parameter provided. {e}"}), 400
-
-    except Exception as e:
-        app.logger.error("Error retrieving orders by order number")
-        return jsonify({"error": "An error occurred while retrieving orders."}), 500
+    order_number = args['order_number']
+    orders = GetOrders(args['store_name'], shopify_access_token, args['api_version'], 
+                       order_number=order_number, num_orders=1)
+    app.logger.info("Num orders found for %s: %d", order_number, len(orders))
+
+    order = orders[0] if orders else f'No orders with order number {order_number} found.'
+    return ojsonify({
+        'order': order,
+    }), 200
 
 
 @app.route('/shopify/order-by-confirmation-number-and-email', methods=['GET'])
-def shopify_order_by_confirmation_number_and_email():
-    """Get list of Shopify orders using order confirmation number and/or user email address.
+@shopify_route(required=('store_name', 'confirmation_number', 'email'),
+               error_message="An error occurred while retrieving orders.")
+def shopify_order_by_confirmation_number_and_email(shopify_access_token: str, args: dict):
+    """Get a Shopify order using order confirmation number and user email address.
     
     Headers:
         X-Shopify-Access-Token (str):  Shopify access token.
@@ -83,53 +197,30 @@ def shopify_order_by_confirmation_number_and_email():
     Query Parameters:
         store_name (str):  Unique Shopify store ID string.
         api_version (str, optional):  Shopify API version. 
-        confirmation_number (str, optional):  Shopify order confirmation number (non unique).
-        email (str, optional):  User email address associated with an order. 
+        confirmation_number (str):  Shopify order confirmation number (non unique).
+        email (str):  User email address associated with an order. 
     
     Returns:
-        A json object with field `order` that is a list of matched order search results.
+        A json object with field `order` that contains the matched order info.
     """
-    shopify_access_token = request.headers.get('X-Shopify-Access-Token')
-    if not shopify_access_token:
-        return jsonify({"error": "Missing or invalid Shopify token in request headers"}), 400
-    
-    store_name = request.args.get('store_name')
-    shopify_api_version = request.args.get('api_version')
-    confirmation_number = request.args.get('confirmation_number')
-    email = request.args.get('email')
-    
-    try:
-        customer_id = GetCustomerID(store_name, email, shopify_access_token, shopify_api_version)
-        if not customer_id:
-            return jsonify({
-            'Error': f'Invalid Email. Customer not found with email {email}',
-        }), 400
+    confirmation_number = args['confirmation_number']
+    email = args['email']
+    orders = GetOrders(args['store_name'], shopify_access_token, args['api_version'],
+                       email=email, confirmation_number=confirmation_number,
+                       fields='summary', num_orders=1)
+    app.logger.info("Num orders found for %s: %d", email, len(orders))
 
-        orders = GetOrdersForCustomerId(store_name, customer_id, shopify_access_token, shopify_api_version)
-        app.logger.info(f"Num orders found for {email}: {len(orders)}")
-        
-        order = f'No orders for {email} with confirmation number {confirmation_number} found.'
-        # Match the order by confirmation number
-        for o in orders:
-            if o['confirmationNumber'] == confirmation_number:
-                order = o
-                break
-
-        return jsonify({
-            'order': order,
-        }), 200
-
-    except ValueError as e:
-        app.logger.error(f"ValueError: {e}")
-        return jsonify({"error": f"Invalid parameter provided. {e}"}), 400
-            
-    except Exception as e:
-        app.logger.error(f"Error retrieving orders by email and confirmation number: {e}")
-        return jsonify({"error": "An error occurred while retrieving orders."}), 500
+    order = orders[0] if orders else f'No orders for {email} with confirmation number {confirmation_number} found.'
+
+    return ojsonify({
+        'order': order,
+    }), 200
 
 
 @app.route('/shopify/products', methods=['GET'])
-def get_shopify_products():
+@shopify_route(required=('store_name',), optional=('product_id', 'product_name'),
+               error_message="An error occurred while retrieving products.")
+def get_shopify_products(shopify_access_token: str, args: dict):
     """Get a list of products from a Shopify store by product_id or search key word.
 
     Headers:
@@ -146,41 +237,29 @@ def get_shopify_products():
         A json object with field `products` that is a list of matched products from the 
         Shopifiy store.
     """
-    shopify_access_token = request.headers.get('X-Shopify-Access-Token')
-    if not shopify_access_token:
-        return jsonify({"error": "Missing or invalid Shopify token in request headers"}), 400
-    
-    store_name = request.args.get('store_name')
-    shopify_api_version = request.args.get('api_version')
-    product_id = request.args.get('product_id')
-    product_name = request.args.get('product_name')
-    
-    try:
-        # Search for products by product_id or product_name
+    store_name = args['store_name']
+    shopify_api_version = args['api_version']
+    product_id = args['product_id']
+    product_name = args['product_name']
+
+    # Search for products by product_id or product_name
+    products = GetProducts(store_name, shopify_access_token, shopify_api_version,
+                       product_id=product_id, product_name=product_name)
+
+    # If no results by title search, search product description. A product_id lookup
+    # takes precedence over product_name, so there was no title search to fall back from.
+    if not products and product_name and not product_id:
+        app.logger.info("No products found by title search, searching by description: %s", product_name)
         products = GetProducts(store_name, shopify_access_token, shopify_api_version,
-                           product_id=product_id, product_name=product_name)
-
-        # If no results by title search, search product description
-        if not products and product_name:
-            app.logger.info(f"No products found by title search, searching by description: {product_name}")
-            products = GetProducts(store_name, shopify_access_token, shopify_api_version,
-                           description=product_name)
-
-        if len(products) <= 0:
-            products = "No products found."
-        app.logger.info(f"Num orders found for product_id: {product_id} product_name: {product_name}: {len(products)}")
-
-        return jsonify({
-            'products': products,
-        }), 200
-        
-    except ValueError as e:
-        app.logger.error(f"ValueError: {e}")
-        return jsonify({"error": f"Invalid parameter provided. {e}"}), 400
-            
-    except Exception as e:
-        app.logger.error(f"Error retrieving orders by product_id or product_name: {e}")
-        return jsonify({"error": "An error occurred while retrieving products."}), 500
+                       description=product_name)
+
+    if len(products) <= 0:
+        products = "No products found."
+    app.logger.info("Num orders found for product_id: %s product_name: %s: %d", product_id, product_name, len(products))
+
+    return _cacheable(ojsonify({
+        'products': products,
+    }), PRODUCTS_CACHE_CONTROL)
 
 
 @app.route('/shopify/get-product-url', methods=['GET'])
@@ -198,13 +277,37 @@ def get_product_url():
     product_handle = request.args.get('product_handle')
 
     if not store_name or not product_handle:
-        return jsonify({
+        return ojsonify({
             'error': 'Missing store_name or product_handle'
         }), 400
+    invalid = _invalid_arg({'store_name': store_name, 'product_handle': product_handle})
+    if invalid:
+        return ojsonify({"error": f"Invalid parameter provided. {invalid}"}), 400
 
-    return jsonify({
+    return _cacheable(ojsonify({
         'product_url': f'https://{store_name}.myshopify.com/products/{product_handle}',
-    }), 200
+    }), PRODUCT_URL_CACHE_CONTROL)
+
+
+def _invalid_arg(args: dict):
+    """Returns the error message for the first arg failing its _ARG_CHECKS check, else None."""
+    for name, value in args.items():
+        check = _ARG_CHECKS.get(name)
+        if value and check and not check[0](value):
+            return check[1]
+    return None
+
+
+def ojsonify(obj, status: int = 200) -> Response:
+    """Drop-in for flask.jsonify that serializes with orjson."""
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+
+
+def _cacheable(response, cache_control: str):
+    """Adds Cache-Control and ETag headers, answering If-None-Match with a 304."""
+    response.headers['Cache-Control'] = cache_control
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 if __name__ == '__main__':
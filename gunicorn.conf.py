@@ -0,0 +1,25 @@
+"""gunicorn.conf.py
+
+gunicorn settings for the proxy service (see apprunner.yaml).
+
+Each worker process keeps its own Prometheus metrics, so they write them to
+PROMETHEUS_MULTIPROC_DIR and /metrics aggregates across workers.
+"""
+import os
+import shutil
+
+# Must be set before prometheus_client is first imported, in the master or a worker.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+
+
+def on_starting(server):
+    """Clears metric files left over from a previous run."""
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    """Drops a dead worker's live metrics so they aren't reported forever."""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -3,460 +3,653 @@
 Functions to query Shopify GraphQL API.
 """
 
-import requests, logging, certifi
+import requests, logging, certifi, functools, hashlib, os, re, threading, time, orjson
+from cachetools import TTLCache
+from prometheus_client import Counter, Histogram
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 NUM_ORDERS_TO_RETURN = 50 # Number of orders to return from Shopify.
+NUM_NESTED_TO_RETURN = 10 # Number of fulfillments/refunds/refund items/returns to return per order.
 NUM_PRODUCTS_TO_RETURN = 20 # Number of produts to return from Shopify.
+MIN_SEARCH_TERM_LENGTH = 3 # Shortest product keyword sent to Shopify search.
 SHOPIFY_API_VERSION = '2025-04' # Default Shopify API version.
+CONNECT_TIMEOUT_S = 3.05 # Seconds to establish a connection to Shopify.
+# Seconds to wait for Shopify to respond; SHOPIFY_TIMEOUT_S overrides.
+READ_TIMEOUT_S = float(os.environ.get('SHOPIFY_TIMEOUT_S', 20))
+REQUEST_TIMEOUT = (CONNECT_TIMEOUT_S, READ_TIMEOUT_S)
+# Seconds to cache product search results; SHOPIFY_PRODUCTS_CACHE_TTL overrides.
+PRODUCTS_CACHE_TTL = float(os.environ.get('SHOPIFY_PRODUCTS_CACHE_TTL', 60))
+PRODUCTS_CACHE_SIZE = 1024 # Max number of cached product searches.
+# Send Automatic Persisted Query hashes instead of full documents. Off by default
+# since support varies across Shopify APIs; enable with SHOPIFY_USE_APQ=1.
+USE_APQ = os.environ.get('SHOPIFY_USE_APQ', '').lower() in ('1', 'true', 'yes')
+POOL_STORES = 50 # Number of per-store connection pools to keep.
+POOL_MAXSIZE = 200 # Keep-alive connections per store; matches gunicorn --worker-connections.
 
-def GetOrders(store_name: str, shopify_access_token: str, 
-              api_verison: str = SHOPIFY_API_VERSION, order_number: str = None, 
-              email: str = None, confirmation_number: str = None) -> list:
-    """Gets orders from Shopify by order_number, user email, and/or confirmation_number.
 
-    Args:
-        store_name (str): Unique Shopify store ID string.
-        shopify_access_token (str): Shopify API access token.
-        api_version (str, optional):  Shopify API version.
-        order_number (str, optional):  Unique Shopify order number.
-        email (str, optional):  User email address associated with an order. 
-        confirmation_number (str, optional):  Shopify order confirmation number (non unique).
+# Per-operation latency and payload size of Shopify calls, exposed on /metrics.
+_CALL_DURATION = Histogram('shopify_call_duration_seconds', 'Duration of Shopify GraphQL calls.',
+                           ['op', 'status'])
+_RESPONSE_BYTES = Counter('shopify_response_bytes', 'Bytes received from Shopify GraphQL calls.',
+                          ['op'])
 
-    returns (list):
-        List of Shopify orders matching search criteria, descending by order creation time.
+
+class ShopifyError(Exception):
+    """Raised when a Shopify API call fails."""
+
+
+class ShopifyTransientError(ShopifyError):
+    """Raised for Shopify failures worth retrying: connection errors, throttling and 5xx."""
+
+
+class ShopifyTimeoutError(ShopifyTransientError):
+    """Raised when Shopify does not respond within REQUEST_TIMEOUT."""
+
+
+# Shared session so Shopify calls reuse pooled keep-alive connections instead of
+# paying a new TCP + TLS handshake on every request.
+_SESSION = requests.Session()
+_SESSION.headers.update({
+    "Content-Type": "application/json",
+    # GraphQL responses are large, repetitive JSON; urllib3 decodes these transparently.
+    "Accept-Encoding": "gzip, deflate, br",
+})
+_SESSION.verify = certifi.where()
+_ADAPTER = HTTPAdapter(
+    pool_connections=POOL_STORES,
+    pool_maxsize=POOL_MAXSIZE,
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.2,
+        # Throttling and gateway errors are transient; a 500 from GraphQL rarely is.
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset(['POST']),
+        # A read timeout already waited READ_TIMEOUT_S; retrying it would hold the
+        # request for several times that. Raise it at once as a Timeout instead.
+        read=False,
+        # Hand back the last response once retries run out, so raise_for_status()
+        # reports the real HTTP status instead of a generic RetryError.
+        raise_on_status=False,
+    ),
+)
+_SESSION.mount('https://', _ADAPTER)
+_SESSION.mount('http://', _ADAPTER)
+
+# Characters with meaning in Shopify search syntax, escaped in user keywords.
+_SEARCH_RESERVED_RE = re.compile(r'([\\:()"])')
+
+# Product searches are idempotent and repeat often across agent sessions.
+_PRODUCTS_CACHE = TTLCache(maxsize=PRODUCTS_CACHE_SIZE, ttl=PRODUCTS_CACHE_TTL)
+_PRODUCTS_CACHE_LOCK = threading.Lock()
+
+
+def _compact_query(document: str) -> str:
+    """Collapses whitespace in a GraphQL document to shrink every request body.
+
+    Safe because none of the documents below contain string literals.
     """
-    api_verison = api_verison or SHOPIFY_API_VERSION
-    url = f"https://{store_name}.myshopify.com/admin/api/{api_verison}/graphql.json"
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": shopify_access_token,
+    return ' '.join(document.split())
+
+
+# GraphQL documents are built once at import rather than on every call.
+_MONEY_FRAGMENT = """
+    fragment Money on MoneyBag {
+        presentmentMoney {
+            amount
+            currencyCode
+        }
     }
-    query = """
-        fragment Money on MoneyBag {
-            presentmentMoney {
-                amount
-                currencyCode
+"""
+
+_RETURN_FRAGMENT = """
+    fragment Return on Return {
+        name
+        id
+        status
+        decline {
+            note
+            reason
+        }
+        totalQuantity
+        returnLineItems (first: $num_nested) {
+            nodes {
+                id
+                quantity
+                refundableQuantity
+                refundedQuantity
+                returnReason 
+                returnReasonNote
             }
         }
-        fragment Return on Return {
-            name
+    }
+"""
+
+# Order selection split into sections that GetOrders composes on demand. The
+# `tracking` section re-selects `fulfillments` so GraphQL merges it into the
+# fulfillments list when both are requested.
+_ORDER_FRAGMENTS = {
+    'core': """
+        fragment OrderCore on Order {
             id
-            status
-            decline {
-                note
-                reason
+            orderNumber: name
+            confirmationNumber
+            displayFulfillmentStatus
+            displayFinancialStatus
+            fullyPaid
+            createdAt
+            requiresShipping
+            processedAt
+            updatedAt
+            cancelReason
+            closed
+            confirmed
+            currencyCode
+            note
+            totalWeightGrams: totalWeight
+            currentTotalPriceSet {...Money}
+            currentShippingPriceSet {...Money}
+            shippingLine {
+                title
+                carrierIdentifier
+                code
+                currentDiscountedPriceSet {...Money}
+                deliveryCategory
+            }
+            refundable
+        }
+    """,
+    'fulfillments': """
+        fragment OrderFulfillments on Order {
+            fulfillments (first: $num_nested) {
+                createdAt
+                deliveredAt
+                displayStatus
+                estimatedDeliveryAt
+                inTransitAt
+                name
+                status
+                requiresShipping
             }
-            totalQuantity
-            returnLineItems (first: 10) {
-                nodes {
-                    id
-                    quantity
-                    refundableQuantity
-                    refundedQuantity
-                    returnReason 
-                    returnReasonNote
+        }
+    """,
+    'tracking': """
+        fragment OrderTracking on Order {
+            fulfillments (first: $num_nested) {
+                trackingInfo {
+                    company
+                    number
+                    url
                 }
             }
         }
-
-        query GetOrderByOrderNumber ($query: String!, $num_orders: Int!) {
-            orders(first: $num_orders, query: $query, sortKey: CREATED_AT, reverse: true) {
-                nodes {
-                    id
-                    orderNumber: name
-                    confirmationNumber
-                    displayFulfillmentStatus
-                    displayFinancialStatus
-                    fullyPaid
-                    createdAt
-                    requiresShipping
-                    processedAt
-                    updatedAt
-                    cancelReason
-                    closed
-                    confirmed
-                    currencyCode
-                    note
-                    totalWeightGrams: totalWeight
-                    currentTotalPriceSet {...Money}
-                    currentShippingPriceSet {...Money}
-                    shippingLine {
-                        title
-                        carrierIdentifier
-                        code
-                        currentDiscountedPriceSet {...Money}
-                        deliveryCategory
-                    }
-                    fulfillments (first: 10) {
-                        createdAt
-                        deliveredAt
-                        displayStatus
-                        estimatedDeliveryAt
-                        inTransitAt
-                        name
-                        status
-                        requiresShipping
-                        trackingInfo {
-                            company
-                            number
-                            url
-                        }
-                    }
-                    refundable
-                    refunds {
-                        return {...Return}
-                        refundLineItems (first: 10) {
-                            nodes {
-                                id
-                                quantity
-                                priceSet {...Money}
-                                subtotalSet {...Money}
-                                totalTaxSet {...Money}
-                            }
-                        }
-                        createdAt
-                        note
+    """,
+    'refunds': """
+        fragment OrderRefunds on Order {
+            refunds (first: $num_nested) {
+                return {...Return}
+                refundLineItems (first: $num_nested) {
+                    nodes {
                         id
+                        quantity
+                        priceSet {...Money}
+                        subtotalSet {...Money}
+                        totalTaxSet {...Money}
                     }
-                    returns (first: 10) {
-                        nodes {...Return}
-                    }
                 }
+                createdAt
+                note
+                id
+            }
+        }
+    """,
+    'returns': """
+        fragment OrderReturns on Order {
+            returns (first: $num_nested) {
+                nodes {...Return}
+            }
+        }
+    """,
+}
+
+# Named section sets accepted as GetOrders `fields`.
+ORDER_FIELD_PRESETS = {
+    'full': frozenset(_ORDER_FRAGMENTS),
+    'summary': frozenset({'core', 'fulfillments'}),
+}
+
+
+# Operation wrappers around the order selection: (operation, parameters, root
+# selection). `{orders}` marks where the orders connection goes.
+_ORDER_QUERY_ROOTS = {
+    'orders': (
+        'GetOrders', '$query: String!',
+        '{orders}',
+    ),
+    'customer': (
+        'GetOrdersByCustomer', '$customer_id: ID!',
+        'customer(id: $customer_id) { {orders} }',
+    ),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _orders_query(sections: frozenset, root: str = 'orders') -> str:
+    """Builds an orders query document selecting only the given order sections.
+
+    Every order query is generated here, so all of them share one order selection.
+    """
+    operation, parameters, selection = _ORDER_QUERY_ROOTS[root]
+    names = [name for name in _ORDER_FRAGMENTS if name in sections]
+    fragments = [_MONEY_FRAGMENT] + [_ORDER_FRAGMENTS[name] for name in names]
+    if sections & {'refunds', 'returns'}:
+        fragments.append(_RETURN_FRAGMENT)
+    spreads = ' '.join(f'...Order{name.capitalize()}' for name in names)
+    # Only the top-level orders search takes a `query` filter argument.
+    query_argument = ', query: $query' if root == 'orders' else ''
+    orders = (f'orders(first: $num_orders{query_argument}, sortKey: CREATED_AT, reverse: true) '
+              f'{{ nodes {{ {spreads} }} }}')
+    # $num_nested may only be declared when a selected section uses it.
+    nested_variable = f', $num_nested: Int = {NUM_NESTED_TO_RETURN}' if sections - {'core'} else ''
+    return _compact_query(' '.join(fragments) + f"""
+        query {operation} ({parameters}, $num_orders: Int!{nested_variable}) {{
+            {selection.replace('{orders}', orders)}
+        }}
+    """)
+
+
+_ORDERS_BY_CUSTOMER_QUERY = _orders_query(ORDER_FIELD_PRESETS['full'], 'customer')
+
+_CUSTOMER_BY_EMAIL_QUERY = _compact_query("""
+    query FindCustomerByEmail ($query: String!) {
+    customers (first: 1, query: $query) {
+        nodes {
+        id
+        email
+        }
+    }
+    }
+""")
+
+_PRODUCTS_QUERY = _compact_query("""
+    fragment Money on MoneyV2 {
+        amount
+        currencyCode
+    }
+
+    query GetProducts ($query: String!) {
+    products(query: $query, first: %d) {
+        edges {
+        node {
+            id
+            title
+            description
+            category {
+                fullName
+                name
+                id
+            }
+            feedback {
+                summary
+            }
+            handle
+            status
+            tags
+            vendor
+            hasOnlyDefaultVariant
+            currentPrice: priceRangeV2 {
+                maxVariantPrice {...Money}
+                minVariantPrice {...Money}
+            }
+            fullPrice: compareAtPriceRange {
+                maxVariantCompareAtPrice {...Money}
+                minVariantCompareAtPrice {...Money}
+            }
+            variants(first: 50) {
+            edges {
+                node {
+                displayName
+                title
+                currentPrice: price
+                fullPrice: compareAtPrice
+                availableForSale
+                OutOfStockOrderingPolicy: inventoryPolicy
+                }
+            }
             }
         }
+        }
+    }
+    }
+""" % NUM_PRODUCTS_TO_RETURN) # Page size is fixed, so it's part of the document.
+
+
+def GetOrders(store_name: str, shopify_access_token: str, 
+              api_version: str = None, order_number: str = None, 
+              email: str = None, confirmation_number: str = None, fields: str = 'full',
+              num_orders: int = NUM_ORDERS_TO_RETURN,
+              num_nested: int = NUM_NESTED_TO_RETURN) -> list:
+    """Gets orders from Shopify by order_number, user email, and/or confirmation_number.
+
+    Args:
+        store_name (str): Unique Shopify store ID string.
+        shopify_access_token (str): Shopify API access token.
+        api_version (str, optional):  Shopify API version. Defaults to SHOPIFY_API_VERSION.
+        order_number (str, optional):  Unique Shopify order number.
+        email (str, optional):  User email address associated with an order. 
+        confirmation_number (str, optional):  Shopify order confirmation number (non unique).
+        fields (str | set, optional):  'full' for all order details, 'summary' to skip
+            refunds, returns and fulfillment tracking info, or a set of sections from
+            'core', 'fulfillments', 'tracking', 'refunds' and 'returns'.
+        num_orders (int, optional):  Max number of orders to return.
+        num_nested (int, optional):  Max number of fulfillments, returns and line
+            items to return per order.
+
+    returns (list):
+        List of Shopify orders matching search criteria, descending by order creation time.
     """
+    api_version = api_version or SHOPIFY_API_VERSION
 
     # Construct query string based on input parameters
     query_string = None
     if order_number is not None:
         query_string = f'name:{order_number}'
     elif email and confirmation_number:
-        query_string = f'email:{email}'
+        # Let Shopify do the filtering; email + confirmation number identify one order.
+        # Values are quoted so they can't add search terms of their own.
+        query_string = (f'email:{_quoted_search_value(email)} '
+                        f'AND confirmation_number:{_quoted_search_value(confirmation_number)}')
     else:
         raise ValueError("Either order_number or both email and confirmation number must be provided.")
 
-    try:
-        # Get recent orders by query
-        response = requests.post(url, headers=headers, json={ 
-            'query': query,  
-            'variables': { 
-                'query': query_string, 
-                'num_orders': NUM_ORDERS_TO_RETURN 
-            }
-        }, verify=certifi.where())
-        response.raise_for_status()
-        result = response.json()
-        orders = _dig(result, ['data', 'orders', 'nodes'], [])
-        return orders
-    
-    except Exception as e:
-        logging.error(e)
-        raise Exception(f"Shopify order search error: {e}")
-    
+    if isinstance(fields, str):
+        if fields not in ORDER_FIELD_PRESETS:
+            raise ValueError(f"fields must be one of {', '.join(ORDER_FIELD_PRESETS)} or a set of sections.")
+        sections = ORDER_FIELD_PRESETS[fields]
+    else:
+        sections = frozenset(fields) | {'core'}
+        unknown = sections - _ORDER_FRAGMENTS.keys()
+        if unknown:
+            raise ValueError(f"Unknown order sections: {', '.join(sorted(unknown))}.")
+    variables = {
+        'query': query_string, 
+        'num_orders': num_orders,
+    }
+    if sections - {'core'}:
+        variables['num_nested'] = num_nested
+
+    orders = _graphql(store_name, shopify_access_token, api_version, _orders_query(sections),
+                      variables, ('data', 'orders', 'nodes'), 'order search')
+    if order_number is None:
+        # Never hand back an order unless its confirmation number really matches.
+        orders = [order for order in orders if order.get('confirmationNumber') == confirmation_number]
+    return orders
+
+
 
 def GetOrdersForCustomerId(store_name: str, customer_id: str, shopify_access_token: str, 
-              api_verison: str = SHOPIFY_API_VERSION) -> list:
+              api_version: str = None) -> list:
     """Gets orders from Shopify placed by a customer.
 
     Args:
         store_name (str): Unique Shopify store ID string.
         shopify_access_token (str): Shopify API access token.
-        api_version (str, optional):  Shopify API version.
+        api_version (str, optional):  Shopify API version. Defaults to SHOPIFY_API_VERSION.
         customer_id (str, optional):  Unique customer ID.
 
     returns (list):
         List of Shopify orders matching search criteria, descending by order creation time.
     """
-    api_verison = api_verison or SHOPIFY_API_VERSION
-    url = f"https://{store_name}.myshopify.com/admin/api/{api_verison}/graphql.json"
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": shopify_access_token,
-    }
-    query = """
-        fragment Money on MoneyBag {
-            presentmentMoney {
-                amount
-                currencyCode
-            }
-        }
-        fragment Return on Return {
-            name
-            id
-            status
-            decline {
-                note
-                reason
-            }
-            totalQuantity
-            returnLineItems (first: 10) {
-                nodes {
-                    id
-                    quantity
-                    refundableQuantity
-                    refundedQuantity
-                    returnReason 
-                    returnReasonNote
-                }
-            }
-        }
-
-        query GetOrderByOrderCustomer ($customer_id: ID!, $num_orders: Int!) {
-            customer(id: $customer_id) {
-            orders(first: $num_orders, sortKey: CREATED_AT, reverse: true) {
-                nodes {
-                    id
-                    orderNumber: name
-                    confirmationNumber
-                    displayFulfillmentStatus
-                    displayFinancialStatus
-                    fullyPaid
-                    createdAt
-                    requiresShipping
-                    processedAt
-                    updatedAt
-                    cancelReason
-                    closed
-                    confirmed
-                    currencyCode
-                    note
-                    totalWeightGrams: totalWeight
-                    currentTotalPriceSet {...Money}
-                    currentShippingPriceSet {...Money}
-                    shippingLine {
-                        title
-                        carrierIdentifier
-                        code
-                        currentDiscountedPriceSet {...Money}
-                        deliveryCategory
-                    }
-                    fulfillments (first: 10) {
-                        createdAt
-                        deliveredAt
-                        displayStatus
-                        estimatedDeliveryAt
-                        inTransitAt
-                        name
-                        status
-                        requiresShipping
-                        trackingInfo {
-                            company
-                            number
-                            url
-                        }
-                    }
-                    refundable
-                    refunds {
-                        return {...Return}
-                        refundLineItems (first: 10) {
-                            nodes {
-                                id
-                                quantity
-                                priceSet {...Money}
-                                subtotalSet {...Money}
-                                totalTaxSet {...Money}
-                            }
-                        }
-                        createdAt
-                        note
-                        id
-                    }
-                    returns (first: 10) {
-                        nodes {...Return}
-                    }
-                }
-            }
-            }
-        }
-    """
-
-    # Construct query string based on input parameters
+    api_version = api_version or SHOPIFY_API_VERSION
     if not customer_id:
-        raise ValueError("Either order_number or both email and confirmation number must be provided.")
-    
-    try:
-        # Get recent orders by query
-        response = requests.post(url, headers=headers, json={ 
-            'query': query,  
-            'variables': { 
-                'customer_id': customer_id, 
-                'num_orders': NUM_ORDERS_TO_RETURN 
-            }
-        }, verify=certifi.where())
-        response.raise_for_status()
-        result = response.json()
-        orders = orders = _dig(result, ['data', 'customer', 'orders', 'nodes'], [])
-        return orders
-    
-    except Exception as e:
-        logging.error(e)
-        raise Exception(f"Shopify order search error: {e}")
+        raise ValueError("Customer ID must be provided.")
+
+    variables = {
+        'customer_id': customer_id, 
+        'num_orders': NUM_ORDERS_TO_RETURN,
+    }
+    return _graphql(store_name, shopify_access_token, api_version, _ORDERS_BY_CUSTOMER_QUERY,
+                    variables, ('data', 'customer', 'orders', 'nodes'), 'customer order search')
 
 
 
 def GetCustomerID(store_name: str, email: str, shopify_access_token: str, 
-                api_verison: str = SHOPIFY_API_VERSION) -> str:
+                api_version: str = None) -> str:
     """Get unique customer ID for a Shopify customer by their email address.
     
     Args:
         store_name (str): Unique Shopify store ID string.
         shopify_access_token (str): Shopify API access token.
-        api_version (str, optional):  Shopify API version.
+        api_version (str, optional):  Shopify API version. Defaults to SHOPIFY_API_VERSION.
         email (str):  Email address associated with a customer.
 
     returns (str):
         Customer ID string if found, else returns None.
 
     """
-    api_verison = api_verison or SHOPIFY_API_VERSION
-    url = f"https://{store_name}.myshopify.com/admin/api/{api_verison}/graphql.json"
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": shopify_access_token,
-    }
-    query = """
-        query FindCustomerByEmail ($query: String!) {
-        customers (first: 1, query: $query) {
-            nodes {
-            id
-            email
-            }
-        }
-        }
-    """
-    # Build search query string based on input parameters
+    api_version = api_version or SHOPIFY_API_VERSION
     if not email:
         raise ValueError("Customer email must be provided.")
     
-    try:
-        # Get products by query
-        response = requests.post(url, headers=headers, json={
-            "query": query, 
-            "variables": { 
-                "query": f"email:{email}"
-            } 
-        }, verify=certifi.where())
-        response.raise_for_status()
-        result = response.json()
-        customers = _dig(result, ['data', 'customers', 'nodes'], [])
-        return customers[0].get('id') if customers else None
-    
-    except Exception as e:
-        logging.error(e)
-        raise Exception(f"Shopify customer search error: {e}")
+    customers = _graphql(store_name, shopify_access_token, api_version, _CUSTOMER_BY_EMAIL_QUERY,
+                         {'query': f'email:{email}'}, ('data', 'customers', 'nodes'), 'customer search')
+    return customers[0].get('id') if customers else None
 
 
 def GetProducts(store_name: str, shopify_access_token: str, 
-                api_verison: str = SHOPIFY_API_VERSION, product_id: str = None, 
-                product_name: str = None, description: str = None) -> list:
+                api_version: str = None, product_id: str = None, 
+                product_name: str = None, description: str = None,
+                strict_prefix: bool = True) -> list:
     """Returns list of products from Shopify that meets search criteria.
 
+    Keyword searches match words by prefix, which Shopify's search index serves far
+    more cheaply than a leading-wildcard "contains" search.
+
     Args:
         store_name (str): Unique Shopify store ID string.
         shopify_access_token (str): Shopify API access token.
-        api_version (str, optional):  Shopify API version.
+        api_version (str, optional):  Shopify API version. Defaults to SHOPIFY_API_VERSION.
         product_id (str, optional):  Unique Shopify store item product ID.
         product_name (str, optional):  Keyword to search for in the product title.
         description (str, optional):  Keyword to search for in the product description.
+        strict_prefix (bool, optional):  If False and the prefix title search finds
+            nothing, retry with a "contains" title search.
 
     returns (list):
         List of Shopify store products matching search criteria.
     """
-    api_verison = api_verison or SHOPIFY_API_VERSION
-    url = f"https://{store_name}.myshopify.com/admin/api/{api_verison}/graphql.json"
-    headers = {
-        "Content-Type": "application/json",
-        "X-Shopify-Access-Token": shopify_access_token,
-    }
-    query = """
-        fragment Money on MoneyV2 {
-            amount
-            currencyCode
-        }
-
-        query GetProducts ($query: String!, $num_products: Int!) {
-        products(query: $query, first: $num_products) {
-            edges {
-            node {
-                id
-                title
-                description
-                category {
-                    fullName
-                    name
-                    id
-                }
-                feedback {
-                    summary
-                }
-                handle
-                status
-                tags
-                vendor
-                hasOnlyDefaultVariant
-                currentPrice: priceRangeV2 {
-                    maxVariantPrice {...Money}
-                    minVariantPrice {...Money}
-                }
-                fullPrice: compareAtPriceRange {
-                    maxVariantCompareAtPrice {...Money}
-                    minVariantCompareAtPrice {...Money}
-                }
-                variants(first: 50) {
-                edges {
-                    node {
-                    displayName
-                    title
-                    currentPrice: price
-                    fullPrice: compareAtPrice
-                    availableForSale
-                    OutOfStockOrderingPolicy: inventoryPolicy
-                    }
-                }
-                }
-            }
-            }
-        }
-        }
-    """
+    api_version = api_version or SHOPIFY_API_VERSION
     # Build search query string based on input parameters
     query_string = None
     if product_id is not None:
         query_string = f'id:{product_id}'
     elif product_name is not None:
-        query_string = f'title:*{product_name}*'
+        product_name = _search_term(product_name, 'product_name')
+        query_string = f'title:{product_name}*'
     elif description is not None:
-        query_string = f'description:*{description}*'
+        description = _search_term(description, 'description')
+        query_string = f'description:{description}*'
     else:
         raise ValueError("product_name or product_id must be provided.")
-    
+
+    products = _search_products(store_name, shopify_access_token, api_version, query_string)
+    if not products and product_name is not None and not strict_prefix:
+        products = _search_products(store_name, shopify_access_token, api_version,
+                                    f'title:*{product_name}*')
+    return products
+
+
+def _search_products(store_name: str, shopify_access_token: str, api_version: str,
+                     query_string: str) -> list:
+    """Runs a product search query, serving repeats from the products cache.
+
+    Results are cached as orjson-encoded bytes rather than nested dicts, which keeps
+    the long-lived cache several times smaller and hands each caller its own copy.
+    """
+    cache_key = (store_name, api_version, _token_key(shopify_access_token), query_string)
+    with _PRODUCTS_CACHE_LOCK:
+        cached = _PRODUCTS_CACHE.get(cache_key)
+    if cached is not None:
+        return orjson.loads(cached)
+
+    products = _graphql(store_name, shopify_access_token, api_version, _PRODUCTS_QUERY,
+                        {'query': query_string}, ('data', 'products', 'edges'), 'product search')
+    cached = orjson.dumps(products)
+    with _PRODUCTS_CACHE_LOCK:
+        _PRODUCTS_CACHE[cache_key] = cached
+    return products
+
+
+def _graphql(store_name: str, shopify_access_token: str, api_version: str, query: str,
+             variables: dict, path: tuple, operation: str) -> list:
+    """Posts a query to a store's Admin GraphQL API and returns the list found at `path`.
+
+    Args:
+        path (tuple):  Keys/indexes leading to the result list in the response JSON.
+        operation (str):  Name of the call for error messages and metrics, e.g. "order search".
+
+    returns (list):
+        The list at `path`, or an empty list if the response doesn't contain it.
+        Raises ShopifyTransientError instead if Shopify throttled the call, or
+        ShopifyError if the response has GraphQL errors and no data at `path`.
+    """
+    url = _graphql_url(store_name, api_version)
+    headers = {"X-Shopify-Access-Token": shopify_access_token}
+    start = time.perf_counter()
+    outcome = 'error'
     try:
-        # Get products by query
-        response = requests.post(url, headers=headers, json={
-            "query": query, 
-            "variables": { 
-                "query": query_string,
-                "num_products": NUM_PRODUCTS_TO_RETURN,
-            } 
-        }, verify=certifi.where())
-        response.raise_for_status()
-        result = response.json()
-        products = _dig(result, ['data', 'products', 'edges'], [])
-        return products
-    
-    except Exception as e:
+        if USE_APQ:
+            # Send only the query hash; include the full document only if the
+            # server hasn't seen it yet.
+            extensions = {'persistedQuery': {'version': 1, 'sha256Hash': _query_hash(query)}}
+            result = _post_graphql(url, headers, orjson.dumps(
+                {'variables': variables, 'extensions': extensions}), operation)
+            if _persisted_query_not_found(result):
+                result = _post_graphql(url, headers, orjson.dumps(
+                    {'query': query, 'variables': variables, 'extensions': extensions}), operation)
+        else:
+            result = _post_graphql(url, headers, _query_body_prefix(query) + orjson.dumps(variables) + b'}',
+                                   operation)
+        found = _dig(result, path, None)
+        # Throttling and other GraphQL errors come back as a 200 with errors and no
+        # data; don't let them pass for an empty result (which callers would cache).
+        if found is None and result.get('errors'):
+            logging.error(result['errors'])
+            if 'THROTTLED' in _error_codes(result):
+                outcome = 'transient'
+                raise ShopifyTransientError(f"Shopify {operation} throttled: {result['errors']}")
+            raise ShopifyError(f"Shopify {operation} error: {result['errors']}")
+        outcome = 'ok'
+        return found if found is not None else []
+
+    except requests.exceptions.Timeout as e:
+        outcome = 'timeout'
+        logging.error(e)
+        raise ShopifyTimeoutError(f"Shopify {operation} timed out: {e}") from e
+
+    except requests.exceptions.ConnectionError as e:
+        outcome = 'transient'
         logging.error(e)
-        raise Exception(f"Shopify product search error: {e}")
+        raise ShopifyTransientError(f"Shopify {operation} error: {e}") from e
 
+    except requests.exceptions.HTTPError as e:
+        logging.error(e)
+        status = e.response.status_code if e.response is not None else None
+        if status is not None and (status == 429 or status >= 500):
+            outcome = 'transient'
+            raise ShopifyTransientError(f"Shopify {operation} error: {e}") from e
+        raise ShopifyError(f"Shopify {operation} error: {e}") from e
+
+    # orjson.JSONDecodeError is a ValueError, which callers treat as bad input.
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+        logging.error(e)
+        raise ShopifyError(f"Shopify {operation} error: {e}") from e
 
-def _dig(data: dict, keys: list[str | int], default: any = None) -> any:
+    finally:
+        _CALL_DURATION.labels(operation, outcome).observe(time.perf_counter() - start)
+
+
+def _post_graphql(url: str, headers: dict, body: bytes, operation: str) -> dict:
+    """POSTs an encoded GraphQL payload and returns the decoded response."""
+    response = _SESSION.post(url, headers=headers, data=body, timeout=REQUEST_TIMEOUT)
+    _RESPONSE_BYTES.labels(operation).inc(len(response.content))
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+
+@functools.lru_cache(maxsize=64)
+def _query_body_prefix(query: str) -> bytes:
+    """Encoded `{"query": ..., "variables":` prefix, so each call only encodes its variables."""
+    return b'{"query":' + orjson.dumps(query) + b',"variables":'
+
+
+@functools.lru_cache(maxsize=64)
+def _query_hash(query: str) -> str:
+    """SHA-256 of a query document, as used by Automatic Persisted Queries."""
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+def _error_codes(result: dict) -> set:
+    """Extension codes of the GraphQL errors in a response, e.g. {'THROTTLED'}."""
+    return {(error.get('extensions') or {}).get('code') for error in result.get('errors') or ()}
+
+
+def _persisted_query_not_found(result: dict) -> bool:
+    """Whether an APQ response asks for the full query document to be sent."""
+    for error in result.get('errors') or ():
+        code = (error.get('extensions') or {}).get('code')
+        if code == 'PERSISTED_QUERY_NOT_FOUND' or error.get('message') == 'PersistedQueryNotFound':
+            return True
+    return False
+
+
+def _search_term(term: str, name: str) -> str:
+    """Validates a search keyword and escapes Shopify search syntax characters."""
+    term = term.strip().lstrip('*')
+    if len(term) < MIN_SEARCH_TERM_LENGTH:
+        raise ValueError(f"{name} must be at least {MIN_SEARCH_TERM_LENGTH} characters.")
+    return _SEARCH_RESERVED_RE.sub(r'\\\1', term)
+
+
+def _quoted_search_value(value: str) -> str:
+    """Quotes a value for a Shopify search query so it is matched as a single term."""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+@functools.lru_cache(maxsize=512)
+def _graphql_url(store_name: str, api_version: str) -> str:
+    """Admin GraphQL endpoint for a store and API version."""
+    return f"https://{store_name}.myshopify.com/admin/api/{api_version}/graphql.json"
+
+
+def _token_key(shopify_access_token: str) -> str:
+    """Digest of an access token, so cache keys don't hold the raw token."""
+    return hashlib.sha256(shopify_access_token.encode()).hexdigest()
+
+
+def _dig(data: dict, keys: tuple[str | int, ...], default: any = None) -> any:
     """Helper function to dig into a nested dictionary."""
+    # Subscript directly: the path is nearly always present, so avoid per-level checks.
     current = data
-    for key in keys:
-        if isinstance(current, dict) and key in current:
-            current = current[key]
-        elif isinstance(current, list) and isinstance(key, int) and key < len(current):
+    try:
+        for key in keys:
             current = current[key]
-        else:
-            return default
+    except (KeyError, IndexError, TypeError):
+        return default
     return current
+
+
+def _warm_connections(store_names: list[str]) -> None:
+    """Opens a pooled connection to each store so first requests skip DNS + TLS setup."""
+    for store_name in store_names:
+        try:
+            _SESSION.head(_graphql_url(store_name, SHOPIFY_API_VERSION), timeout=CONNECT_TIMEOUT_S)
+        except Exception as e:
+            logging.warning("Could not warm connection to %s: %s", store_name, e)
+
+
+# Stores listed in SHOPIFY_STORES (comma separated) are warmed in the background
+# at import, so startup isn't held up by slow or unreachable stores.
+_WARM_STORES = [name.strip() for name in os.environ.get('SHOPIFY_STORES', '').split(',') if name.strip()]
+if _WARM_STORES:
+    threading.Thread(target=_warm_connections, args=(_WARM_STORES,), daemon=True).start()